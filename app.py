@@ -1,26 +1,112 @@
+import asyncio
 import os
+import re
+import shutil
 import sqlite3
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
-from flask import Flask, g, jsonify, render_template, request, send_from_directory, session
+import orjson
+from quart import Quart, Response, g, render_template, request, send_from_directory, session
 from werkzeug.security import check_password_hash, generate_password_hash
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(APP_DIR, "marketplace.db")
 UPLOAD_DIR = os.path.join(APP_DIR, "uploads")
+# Raw uploads wait here for the background optimizer. Deliberately outside
+# UPLOAD_DIR so unprocessed bytes are never served.
+STAGING_DIR = os.path.join(APP_DIR, "upload-staging")
+# Staged files older than this were orphaned by a crash/restart.
+STAGING_MAX_AGE = 60 * 60
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY", "dev-only-change-me")
+app = Quart(__name__)
 app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_CONTENT_LENGTH", str(10 * 1024 * 1024)))
 
+# With MEMCACHED_SERVERS set (e.g. "10.0.0.5:11211") sessions live
+# server-side in Memcached and are shared by every worker; the cookie only
+# carries the (signed) session id. Otherwise Quart's signed cookie sessions
+# are used. Both need SECRET_KEY; only cookie mode has a dev fallback.
+MEMCACHED_SERVERS = os.getenv("MEMCACHED_SERVERS")
+if MEMCACHED_SERVERS:
+    from quart_session import Session
+
+    if "," in MEMCACHED_SERVERS:
+        # Quart-Session's aiomcache client talks to a single server.
+        raise RuntimeError("MEMCACHED_SERVERS must name exactly one host:port")
+    if not os.getenv("SECRET_KEY"):
+        raise RuntimeError("SECRET_KEY is required when MEMCACHED_SERVERS is set")
+    app.secret_key = os.getenv("SECRET_KEY")
+    host, port = MEMCACHED_SERVERS.strip().rsplit(":", 1)
+    app.config["SESSION_TYPE"] = "memcached"
+    app.config["SESSION_USE_SIGNER"] = True
+    app.config["SESSION_MEMCACHED_HOST"] = host
+    app.config["SESSION_MEMCACHED_PORT"] = int(port)
+    Session(app)
+
+    from itsdangerous import Signer
+
+    class _TextSigner(Signer):
+        # Quart-Session hands sign()'s bytes straight to set_cookie, which
+        # Werkzeug 3 rejects; give it the signed sid as text.
+        def sign(self, value):
+            return super().sign(value).decode()
+
+    _sid_signer = _TextSigner(app.secret_key, salt="quart-session", key_derivation="hmac")
+    app.session_interface._get_signer = lambda _app: _sid_signer
+else:
+    app.secret_key = os.getenv("SECRET_KEY", "dev-only-change-me")
+
+# Image re-encoding runs here instead of on the request thread; Pillow releases
+# the GIL inside its codecs so threads do scale across cores.
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+# Serialized GET /api/products body, reused while the catalog signature
+# (see catalog_signature) is unchanged.
+_LIST_CACHE = {"sig": None, "body": None}
+
+
+def connect_db():
+    # Autocommit mode (isolation_level=None): single statements commit on their
+    # own and multi-statement work opens its own BEGIN/COMMIT.
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute("PRAGMA temp_store = MEMORY")
+    db.execute("PRAGMA mmap_size = 268435456")
+    db.execute("PRAGMA cache_size = -65536")
+    db.execute("PRAGMA foreign_keys = ON")
+    return db
+
+
+def ojson(obj, status=200):
+    # orjson encodes in native code and returns bytes directly.
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+
+def invalidate_list_cache():
+    _LIST_CACHE["sig"] = None
+
+
+@contextmanager
+def transaction(db):
+    # connect_db() connections are in autocommit mode, where `with db:` does
+    # not open a transaction; do it explicitly.
+    db.execute("BEGIN")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
 
 def get_db():
     db = getattr(g, "_db", None)
     if db is None:
-        db = g._db = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-        db.execute("PRAGMA foreign_keys = ON")
+        db = g._db = connect_db()
     return db
 
 
@@ -31,11 +117,27 @@ def close_db(_exc):
         db.close()
 
 
+def sweep_staging_dir():
+    cutoff = time.time() - STAGING_MAX_AGE
+    with os.scandir(STAGING_DIR) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
 def init_db():
     os.makedirs(UPLOAD_DIR, exist_ok=True)
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    sweep_staging_dir()
 
     db = sqlite3.connect(DB_PATH)
     try:
+        # WAL is persistent in the db file, so it only needs setting once;
+        # readers then no longer block on writers.
+        db.execute("PRAGMA journal_mode = WAL")
         db.execute("PRAGMA foreign_keys = ON")
         db.execute(
             """
@@ -121,10 +223,38 @@ def init_db():
                 """
             )
 
+        def migration_v5():
+            # Covering index for the per-product image lookup in list_products;
+            # its (product_id) prefix makes the v4 index redundant.
+            db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_product_images_pid_sort
+                ON product_images(product_id, sort_order, id, filename)
+                """
+            )
+            db.execute("DROP INDEX IF EXISTS idx_product_images_product_id")
+
+        def migration_v6():
+            # Pixel width of the stored image (NULL for pre-WebP uploads), so
+            # srcset can advertise real widths. Rebuild the covering index to
+            # include it.
+            cols = db.execute("PRAGMA table_info(product_images)").fetchall()
+            if "width" not in {c[1] for c in cols}:
+                db.execute("ALTER TABLE product_images ADD COLUMN width INTEGER")
+            db.execute("DROP INDEX IF EXISTS idx_product_images_pid_sort")
+            db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_product_images_pid_sort_w
+                ON product_images(product_id, sort_order, id, filename, width)
+                """
+            )
+
         apply(1, migration_v1)
         apply(2, migration_v2)
         apply(3, migration_v3)
         apply(4, migration_v4)
+        apply(5, migration_v5)
+        apply(6, migration_v6)
 
     finally:
         db.close()
@@ -134,13 +264,15 @@ def now_utc():
     return datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
 
+_NON_DIGIT = re.compile(r"\D")
+
+
 def normalize_whatsapp(s: str) -> str:
-    s = (s or "").strip().replace(" ", "")
+    s = (s or "").strip()
     # Keep leading + if present, otherwise digits only.
     if s.startswith("+"):
-        rest = "".join(ch for ch in s[1:] if ch.isdigit())
-        return "+" + rest
-    return "".join(ch for ch in s if ch.isdigit())
+        return "+" + _NON_DIGIT.sub("", s[1:])
+    return _NON_DIGIT.sub("", s)
 
 
 def current_seller_id():
@@ -149,59 +281,233 @@ def current_seller_id():
 
 
 def get_current_seller_row():
+    # Served from the session snapshot stored at login/register; the DB is only
+    # hit for sessions that predate it.
     sid = current_seller_id()
     if not sid:
         return None
+    cached = session.get("seller_row")
+    if isinstance(cached, dict) and cached.get("id") == sid:
+        return cached
     db = get_db()
-    return db.execute(
+    row = db.execute(
         "SELECT id, name, whatsapp, created_at FROM sellers WHERE id=?",
         (sid,),
     ).fetchone()
+    if not row:
+        return None
+    session["seller_row"] = dict(row)
+    return session["seller_row"]
+
+
+async def login_seller(seller: dict):
+    # Start from a clean session. With server-side sessions also move to a
+    # fresh id, so an id planted before login never becomes authenticated.
+    old_sid = getattr(session, "sid", None)
+    session.clear()
+    if old_sid is not None:
+        iface = app.session_interface
+        session.sid = str(uuid.uuid4())
+        await iface.delete(key=iface.key_prefix + old_sid, app=app)
+    session["seller_id"] = seller["id"]
+    session["seller_row"] = seller
+
+
+# Accepted input formats (Pillow format names). Whatever comes in is stored
+# as WebP.
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "WEBP"}
+
+# Uploads are untrusted and a tiny compressed file can declare a huge canvas,
+# so refuse anything above this many pixels before decoding it.
+MAX_IMAGE_PIXELS = 40_000_000
+
+# Stored originals are downscaled to fit in this box; JPEGs are decoded at a
+# reduced scale straight away when they are much larger.
+MAX_STORED_EDGE = 2048
+
+WEBP_SAVE_OPTIONS = {"quality": 82, "method": 6}
+
+# Downscaled copies written next to each stored image as <stem>_<width>.webp,
+# advertised to clients through srcset.
+THUMBNAIL_WIDTHS = (320, 768)
+THUMBNAIL_SAVE_OPTIONS = {"quality": 80, "method": 6}
+
+# Stored upload names are random and never rewritten, so clients may cache
+# them forever.
+UPLOAD_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def _sniff_format(head: bytes):
+    # Identify the container from its magic number; None unless it is one of
+    # ALLOWED_IMAGE_FORMATS.
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head[0:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def stage_upload_image(file_storage) -> str:
+    # Magic-number format check on the first 16 bytes, then spool the raw
+    # upload to a temp file. Pillow never runs here: the background
+    # optimizer's full decode is what rejects corrupt images. Blocking file
+    # I/O, so call it via asyncio.to_thread. Returns the temp path.
+    file_storage.stream.seek(0)
+    head = file_storage.stream.read(16)
+    fmt = _sniff_format(head)
+    if fmt is None:
+        raise ValueError("Unsupported image format")
 
+    file_storage.stream.seek(0)
+    tmp_path = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    with open(tmp_path, "wb") as out:
+        shutil.copyfileobj(file_storage.stream, out)
+    return tmp_path
 
-ALLOWED_IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
 
+def product_upload_dir(product_id: int) -> str:
+    # Each product's images (and thumbnails) live under UPLOAD_DIR/<product_id>/.
+    return os.path.join(UPLOAD_DIR, str(product_id))
 
-def _sniff_and_get_ext(file_storage):
-    # Validate image with Pillow; returns safe extension.
-    from PIL import Image
 
-    file_storage.stream.seek(0)
-    img = Image.open(file_storage.stream)
-    img.verify()
-    fmt = (img.format or "").upper()
-
-    if fmt == "JPEG":
-        ext = ".jpg"
-    elif fmt == "PNG":
-        ext = ".png"
-    elif fmt == "WEBP":
-        ext = ".webp"
-    else:
+def save_upload_image(src, product_id: int):
+    # Decode once with Pillow (raises on corrupt data), then re-encode as WebP.
+    # Returns (path relative to UPLOAD_DIR, stored pixel width).
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    try:
+        img = Image.open(src)
+    except Image.DecompressionBombError:
+        raise ValueError("Image is too large")
+    except Exception:
+        raise ValueError("Invalid image file")
+    if img.format not in ALLOWED_IMAGE_FORMATS:
         raise ValueError("Unsupported image format")
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        raise ValueError("Image is too large")
 
-    file_storage.stream.seek(0)
-    return ext
+    if img.format == "JPEG":
+        img.draft("RGB", (MAX_STORED_EDGE, MAX_STORED_EDGE))
+    try:
+        img.load()
+    except Exception:
+        raise ValueError("Invalid image file")
 
+    # Keep the colour profile (e.g. Display P3 phone photos); the transpose and
+    # convert below may drop it from img.info.
+    icc = img.info.get("icc_profile")
+    # EXIF is not carried over, so bake the camera orientation into the pixels.
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    img.thumbnail((MAX_STORED_EDGE, MAX_STORED_EDGE))
 
-def save_upload_image(file_storage) -> str:
-    ext = _sniff_and_get_ext(file_storage)
-    if ext not in ALLOWED_IMAGE_EXTS:
-        raise ValueError("Unsupported image type")
+    subdir = product_upload_dir(product_id)
+    os.makedirs(subdir, exist_ok=True)
 
-    filename = f"{uuid.uuid4().hex}{ext}"
-    abs_path = os.path.join(UPLOAD_DIR, filename)
+    filename = f"{uuid.uuid4().hex}.webp"
+    abs_path = os.path.join(subdir, filename)
 
     # Ensure we never overwrite (extremely unlikely, but safe)
     while os.path.exists(abs_path):
-        filename = f"{uuid.uuid4().hex}{ext}"
-        abs_path = os.path.join(UPLOAD_DIR, filename)
+        filename = f"{uuid.uuid4().hex}.webp"
+        abs_path = os.path.join(subdir, filename)
+
+    img.save(abs_path, "WEBP", icc_profile=icc, **WEBP_SAVE_OPTIONS)
+
+    # Only widths below the source are useful. Each variant is exactly w wide
+    # (srcset advertises it as such) and is scaled down from the previous,
+    # larger one rather than from a copy of the full-size image.
+    stem = filename[: -len(".webp")]
+    variant = img
+    for w in sorted(thumbnail_widths(img.width), reverse=True):
+        h = max(1, round(variant.height * w / variant.width))
+        variant = variant.resize((w, h), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        variant.save(os.path.join(subdir, f"{stem}_{w}.webp"), "WEBP", icc_profile=icc, **THUMBNAIL_SAVE_OPTIONS)
+    return f"{product_id}/{filename}", img.width
+
+
+def thumbnail_widths(width: int):
+    return [w for w in THUMBNAIL_WIDTHS if w < width]
+
 
-    file_storage.save(abs_path)
-    return filename
+def stored_image_files(filename: str):
+    # The stored image plus any thumbnails it may have (only .webp uploads).
+    names = [filename]
+    if filename.endswith(".webp"):
+        stem = filename[: -len(".webp")]
+        names.extend(f"{stem}_{w}.webp" for w in THUMBNAIL_WIDTHS)
+    return names
 
 
-def product_to_dict(row, images_by_product_id=None):
+def remove_product_files(product_id: int, legacy_filenames=()):
+    shutil.rmtree(product_upload_dir(product_id), ignore_errors=True)
+    for filename in legacy_filenames:
+        for fn in stored_image_files(filename):
+            try:
+                os.remove(os.path.join(UPLOAD_DIR, fn))
+            except OSError:
+                pass
+
+
+def image_to_dict(filename: str, width=None):
+    # width is only recorded for WebP uploads, which are the ones with thumbnails.
+    d = {"src": f"/uploads/{filename}"}
+    if width:
+        stem = filename[: -len(".webp")]
+        candidates = [f"/uploads/{stem}_{w}.webp {w}w" for w in thumbnail_widths(width)]
+        candidates.append(f"/uploads/{filename} {width}w")
+        d["srcset"] = ", ".join(candidates)
+    return d
+
+
+def _optimize_and_register(product_id: int, staged, created_at: str):
+    # Runs on EXECUTOR: optimize a product's staged uploads, then attach them
+    # all in one transaction. staged is a list of (tmp_path, sort_order).
+    rows = []
+    try:
+        for tmp_path, sort_order in staged:
+            try:
+                filename, width = save_upload_image(tmp_path, product_id)
+            except ValueError:
+                app.logger.warning("skipping invalid image for product %s", product_id)
+                continue
+            rows.append((product_id, filename, width, sort_order, created_at))
+
+        if rows:
+            db = connect_db()
+            try:
+                with transaction(db):
+                    db.executemany(
+                        "INSERT INTO product_images (product_id, filename, width, sort_order, created_at) VALUES (?, ?, ?, ?, ?)",
+                        rows,
+                    )
+            finally:
+                db.close()
+            invalidate_list_cache()
+    except Exception:
+        # Most likely the product was deleted while we were encoding. This job
+        # is the only writer of the product's directory, so drop all of it.
+        app.logger.exception("image processing failed for product %s", product_id)
+        shutil.rmtree(product_upload_dir(product_id), ignore_errors=True)
+    finally:
+        for tmp_path, _ in staged:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+# Separators for the GROUP_CONCAT'd image list: images are split by the ASCII
+# unit separator, and each is "<filename>\x1e<width>".
+IMAGE_LIST_SEP = "\x1f"
+IMAGE_FIELD_SEP = "\x1e"
+
+
+def product_to_dict(row):
     d = dict(row)
 
     seller = None
@@ -213,9 +519,12 @@ def product_to_dict(row, images_by_product_id=None):
         }
     d["seller"] = seller
 
-    pid = d.get("id")
-    imgs = (images_by_product_id or {}).get(pid, [])
-    d["images"] = [f"/uploads/{fn}" for fn in imgs]
+    image_list = d.pop("image_list", None)
+    imgs = image_list.split(IMAGE_LIST_SEP) if image_list else []
+    d["images"] = []
+    for item in imgs:
+        fn, _, width = item.partition(IMAGE_FIELD_SEP)
+        d["images"].append(image_to_dict(fn, int(width) if width else None))
 
     # remove join helper fields
     d.pop("seller_name", None)
@@ -225,68 +534,66 @@ def product_to_dict(row, images_by_product_id=None):
 
 
 @app.get("/")
-def home():
-    return render_template("index.html")
+async def home():
+    return await render_template("index.html")
 
 
 @app.get("/uploads/<path:filename>")
-def uploads(filename):
-    return send_from_directory(UPLOAD_DIR, filename)
+async def uploads(filename):
+    resp = await send_from_directory(UPLOAD_DIR, filename, cache_timeout=UPLOAD_MAX_AGE)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
 
 
 @app.get("/api/sellers/me")
-def sellers_me():
+async def sellers_me():
     row = get_current_seller_row()
     if not row:
-        return jsonify({"error": "not logged in"}), 401
-    return jsonify(dict(row))
+        return ojson({"error": "not logged in"}, 401)
+    return ojson(dict(row))
 
 
 @app.post("/api/sellers/register")
-def sellers_register():
-    data = request.get_json(silent=True) or {}
+async def sellers_register():
+    data = await request.get_json(silent=True) or {}
     name = (data.get("name") or "").strip()
     whatsapp = normalize_whatsapp(data.get("whatsapp") or "")
     pin = (data.get("pin") or "").strip()
 
     if len(name) < 2 or len(name) > 60:
-        return jsonify({"error": "Invalid name"}), 400
+        return ojson({"error": "Invalid name"}, 400)
     if not whatsapp or len(whatsapp) < 10:
-        return jsonify({"error": "Invalid WhatsApp"}), 400
+        return ojson({"error": "Invalid WhatsApp"}, 400)
     if not pin.isdigit() or not (4 <= len(pin) <= 8):
-        return jsonify({"error": "PIN must be 4-8 digits"}), 400
+        return ojson({"error": "PIN must be 4-8 digits"}, 400)
 
     db = get_db()
     created_at = now_utc()
-    pin_hash = generate_password_hash(pin)
+    # scrypt is deliberately slow; keep it off the event loop.
+    pin_hash = await asyncio.to_thread(generate_password_hash, pin, method="scrypt", salt_length=16)
 
     try:
         cur = db.execute(
             "INSERT INTO sellers (name, whatsapp, pin_hash, created_at) VALUES (?, ?, ?, ?)",
             (name, whatsapp, pin_hash, created_at),
         )
-        db.commit()
     except sqlite3.IntegrityError:
-        return jsonify({"error": "WhatsApp already registered"}), 409
-
-    seller_id = cur.lastrowid
-    session["seller_id"] = seller_id
+        return ojson({"error": "WhatsApp already registered"}, 409)
 
-    row = db.execute(
-        "SELECT id, name, whatsapp, created_at FROM sellers WHERE id=?",
-        (seller_id,),
-    ).fetchone()
-    return jsonify(dict(row)), 201
+    seller = {"id": cur.lastrowid, "name": name, "whatsapp": whatsapp, "created_at": created_at}
+    await login_seller(seller)
+    return ojson(seller, 201)
 
 
 @app.post("/api/sellers/login")
-def sellers_login():
-    data = request.get_json(silent=True) or {}
+async def sellers_login():
+    data = await request.get_json(silent=True) or {}
     whatsapp = normalize_whatsapp(data.get("whatsapp") or "")
     pin = (data.get("pin") or "").strip()
 
     if not whatsapp or not pin:
-        return jsonify({"error": "whatsapp and pin required"}), 400
+        return ojson({"error": "whatsapp and pin required"}, 400)
 
     db = get_db()
     row = db.execute(
@@ -294,25 +601,59 @@ def sellers_login():
         (whatsapp,),
     ).fetchone()
     if not row:
-        return jsonify({"error": "Invalid credentials"}), 401
+        return ojson({"error": "Invalid credentials"}, 401)
 
-    if not check_password_hash(row["pin_hash"], pin):
-        return jsonify({"error": "Invalid credentials"}), 401
+    if not await asyncio.to_thread(check_password_hash, row["pin_hash"], pin):
+        return ojson({"error": "Invalid credentials"}, 401)
 
-    session["seller_id"] = row["id"]
-    return jsonify({"id": row["id"], "name": row["name"], "whatsapp": row["whatsapp"], "created_at": row["created_at"]})
+    seller = {"id": row["id"], "name": row["name"], "whatsapp": row["whatsapp"], "created_at": row["created_at"]}
+    await login_seller(seller)
+    return ojson(seller)
 
 
 @app.post("/api/sellers/logout")
-def sellers_logout():
+async def sellers_logout():
     session.pop("seller_id", None)
-    return jsonify({"ok": True})
+    session.pop("seller_row", None)
+    return ojson({"ok": True})
+
+
+def catalog_signature(db) -> str:
+    # Cheap index probes that change whenever a product or image is added or
+    # removed; also catches writes made by other worker processes. Doubles as
+    # the listing's ETag.
+    row = db.execute(
+        """
+        SELECT
+            (SELECT MAX(id) FROM products),
+            (SELECT COUNT(*) FROM products),
+            (SELECT MAX(id) FROM product_images)
+        """
+    ).fetchone()
+    return "-".join(str(v) for v in row)
+
+
+def _catalog_response(body: bytes, sig: str, status: int = 200):
+    resp = Response(body, status=status, mimetype="application/json")
+    resp.set_etag(sig)
+    # Clients may keep a copy but must revalidate it every time.
+    resp.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return resp
 
 
 @app.get("/api/products")
-def list_products():
+async def list_products():
     db = get_db()
 
+    sig = catalog_signature(db)
+    if request.if_none_match.contains_weak(sig):
+        return _catalog_response(b"", sig, 304)
+    if _LIST_CACHE["sig"] == sig:
+        return _catalog_response(_LIST_CACHE["body"], sig)
+
+    # One round trip: images are aggregated per product in a correlated
+    # subquery (the inner ORDER BY keeps sort_order, since SQLite < 3.44 has
+    # no ORDER BY inside GROUP_CONCAT).
     rows = db.execute(
         """
         SELECT
@@ -323,32 +664,34 @@ def list_products():
             p.created_at,
             p.seller_id,
             s.name AS seller_name,
-            s.whatsapp AS seller_whatsapp
+            s.whatsapp AS seller_whatsapp,
+            (
+                SELECT GROUP_CONCAT(image, char(31))
+                FROM (
+                    SELECT filename || char(30) || IFNULL(width, '') AS image
+                    FROM product_images
+                    WHERE product_id = p.id
+                    ORDER BY sort_order ASC, id ASC
+                )
+            ) AS image_list
         FROM products p
         LEFT JOIN sellers s ON s.id = p.seller_id
         ORDER BY p.id DESC
         """
     ).fetchall()
 
-    product_ids = [r["id"] for r in rows]
-    images_by_pid = {}
-    if product_ids:
-        qmarks = ",".join(["?"] * len(product_ids))
-        img_rows = db.execute(
-            f"SELECT product_id, filename FROM product_images WHERE product_id IN ({qmarks}) ORDER BY sort_order ASC, id ASC",
-            product_ids,
-        ).fetchall()
-        for ir in img_rows:
-            images_by_pid.setdefault(ir["product_id"], []).append(ir["filename"])
-
-    return jsonify([product_to_dict(r, images_by_pid) for r in rows])
+    body = orjson.dumps([product_to_dict(r) for r in rows])
+    # body first, so a reader never pairs a fresh sig with a stale body
+    _LIST_CACHE["body"] = body
+    _LIST_CACHE["sig"] = sig
+    return _catalog_response(body, sig)
 
 
 @app.delete("/api/products/<int:product_id>")
-def delete_product(product_id: int):
+async def delete_product(product_id: int):
     seller_id = current_seller_id()
     if not seller_id:
-        return jsonify({"error": "login required"}), 401
+        return ojson({"error": "login required"}, 401)
 
     db = get_db()
     row = db.execute(
@@ -356,64 +699,80 @@ def delete_product(product_id: int):
         (product_id,),
     ).fetchone()
     if not row:
-        return jsonify({"error": "not found"}), 404
+        return ojson({"error": "not found"}, 404)
 
     if row["seller_id"] != seller_id:
-        return jsonify({"error": "forbidden"}), 403
-
-    img_rows = db.execute(
-        "SELECT filename FROM product_images WHERE product_id=?",
-        (product_id,),
-    ).fetchall()
-    filenames = [r["filename"] for r in img_rows]
+        return ojson({"error": "forbidden"}, 403)
+
+    # Uploads from before per-product directories sit flat in UPLOAD_DIR
+    # (no "/" in the name) and have to be removed one by one.
+    legacy_filenames = [
+        r["filename"]
+        for r in db.execute(
+            "SELECT filename FROM product_images WHERE product_id=? AND instr(filename, '/') = 0",
+            (product_id,),
+        ).fetchall()
+    ]
 
     db.execute("DELETE FROM products WHERE id=?", (product_id,))
-    db.commit()
+    invalidate_list_cache()
 
-    # Best-effort file cleanup
-    for fn in filenames:
-        try:
-            os.remove(os.path.join(UPLOAD_DIR, fn))
-        except OSError:
-            pass
+    # Best-effort file cleanup; blocking disk I/O, so off the event loop.
+    await asyncio.to_thread(remove_product_files, product_id, legacy_filenames)
 
-    return jsonify({"ok": True})
+    return ojson({"ok": True})
 
 
 @app.post("/api/products")
-def create_product():
-    seller_id = current_seller_id()
-    if not seller_id:
-        return jsonify({"error": "login required"}), 401
+async def create_product():
+    seller = get_current_seller_row()
+    if not seller:
+        return ojson({"error": "login required"}, 401)
+    seller_id = seller["id"]
 
     # Multipart form expected for uploads
-    name = (request.form.get("name") or "").strip()
-    details = (request.form.get("details") or "").strip()
+    form = await request.form
+    name = (form.get("name") or "").strip()
+    details = (form.get("details") or "").strip()
 
-    price_raw = request.form.get("price")
+    price_raw = form.get("price")
     try:
         price = float(price_raw)
     except (TypeError, ValueError):
         price = None
 
     if not name or price is None or price < 0 or not details:
-        return (
-            jsonify(
-                {
-                    "error": "Invalid input",
-                    "fields": {
-                        "name": "required",
-                        "price": "number >= 0",
-                        "details": "required",
-                    },
-                }
-            ),
+        return ojson(
+            {
+                "error": "Invalid input",
+                "fields": {
+                    "name": "required",
+                    "price": "number >= 0",
+                    "details": "required",
+                },
+            },
             400,
         )
 
-    files = request.files.getlist("images")
+    files = (await request.files).getlist("images")
     if files and len(files) > 5:
-        return jsonify({"error": "Max 5 images allowed"}), 400
+        return ojson({"error": "Max 5 images allowed"}, 400)
+
+    # Only stage uploads here; decode/encode happens on EXECUTOR and the
+    # images show up in /api/products once they are done.
+    staged = []
+    try:
+        for i, f in enumerate(files or []):
+            if not f or not getattr(f, "filename", ""):
+                continue
+            staged.append((await asyncio.to_thread(stage_upload_image, f), i))
+    except ValueError as e:
+        for tmp_path, _ in staged:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return ojson({"error": str(e)}, 400)
 
     db = get_db()
     created_at = now_utc()
@@ -422,73 +781,84 @@ def create_product():
         "INSERT INTO products (name, price, details, created_at, seller_id) VALUES (?, ?, ?, ?, ?)",
         (name, price, details, created_at, seller_id),
     )
-    db.commit()
-
     product_id = cur.lastrowid
 
-    saved_filenames = []
-    try:
-        for i, f in enumerate(files or []):
-            if not f or not getattr(f, "filename", ""):
-                continue
-            filename = save_upload_image(f)
-            saved_filenames.append(filename)
-            db.execute(
-                "INSERT INTO product_images (product_id, filename, sort_order, created_at) VALUES (?, ?, ?, ?)",
-                (product_id, filename, i, created_at),
-            )
-        db.commit()
-    except ValueError as e:
-        # cleanup product row + any saved files
-        db.execute("DELETE FROM products WHERE id=?", (product_id,))
-        db.commit()
-        for fn in saved_filenames:
-            try:
-                os.remove(os.path.join(UPLOAD_DIR, fn))
-            except OSError:
-                pass
-        return jsonify({"error": str(e)}), 400
+    invalidate_list_cache()
+    if staged:
+        EXECUTOR.submit(_optimize_and_register, product_id, staged, created_at)
+
+    # Everything in the response is already in hand; no read-back query.
+    row = {
+        "id": product_id,
+        "name": name,
+        "price": price,
+        "details": details,
+        "created_at": created_at,
+        "seller_id": seller_id,
+        "seller_name": seller["name"],
+        "seller_whatsapp": seller["whatsapp"],
+    }
+    return ojson(product_to_dict(row), 201)
+
+
+# Rule-based fallback replies, pre-encoded once: (keywords, JSON body).
+# Keywords match as substrings, so "shipping" still hits "ship".
+_CHAT_RULES = tuple(
+    (keywords, orjson.dumps({"reply": reply}))
+    for keywords, reply in (
+        (
+            ("price", "rates"),
+            "Aap product cards par price dekh sakte hain. Jo pasand aaye us par 'Buy on WhatsApp' dabayein.",
+        ),
+        (
+            ("delivery", "ship"),
+            "Delivery details seller WhatsApp par confirm karega. Buy button se contact karein.",
+        ),
+        (
+            ("refund", "return"),
+            "Return/Refund policy seller se WhatsApp par confirm hoti hai. Product details share kar dein.",
+        ),
+    )
+)
+_CHAT_DEFAULT_REPLY = orjson.dumps(
+    {
+        "reply": "Ji bilkul—main help kar deta hoon. Aap apna sawal detail me batayein ya product select karke Buy on WhatsApp use karein."
+    }
+)
 
-    row = db.execute(
-        """
-        SELECT
-            p.id,
-            p.name,
-            p.price,
-            p.details,
-            p.created_at,
-            p.seller_id,
-            s.name AS seller_name,
-            s.whatsapp AS seller_whatsapp
-        FROM products p
-        LEFT JOIN sellers s ON s.id = p.seller_id
-        WHERE p.id=?
-        """,
-        (product_id,),
-    ).fetchone()
 
-    images_by_pid = {product_id: saved_filenames}
-    return jsonify(product_to_dict(row, images_by_pid)), 201
+_ANTHROPIC_CLIENT = None
+
+
+def _get_anthropic():
+    # One async client per process so its HTTP connection pool is reused across
+    # requests. Returns None when ANTHROPIC_API_KEY is not set.
+    global _ANTHROPIC_CLIENT
+    if _ANTHROPIC_CLIENT is None:
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        if not api_key:
+            return None
+        # Lazy import so app still works without the package.
+        from anthropic import AsyncAnthropic
+
+        _ANTHROPIC_CLIENT = AsyncAnthropic(api_key=api_key)
+    return _ANTHROPIC_CLIENT
 
 
 # Basic customer-care chatbot endpoint.
 # By default uses a simple rule-based fallback.
 # If you set ANTHROPIC_API_KEY in env, it will use Anthropic.
 @app.post("/api/chat")
-def chat():
-    data = request.get_json(silent=True) or {}
+async def chat():
+    data = await request.get_json(silent=True) or {}
     message = (data.get("message") or "").strip()
     if not message:
-        return jsonify({"error": "message required"}), 400
+        return ojson({"error": "message required"}, 400)
 
-    api_key = os.getenv("ANTHROPIC_API_KEY")
-    if api_key:
+    if os.getenv("ANTHROPIC_API_KEY"):
         try:
-            # Lazy import so app still works without the package.
-            from anthropic import Anthropic
-
-            client = Anthropic(api_key=api_key)
-            resp = client.messages.create(
+            # Awaiting here frees the worker to serve other requests meanwhile.
+            resp = await _get_anthropic().messages.create(
                 model=os.getenv("ANTHROPIC_MODEL", "claude-3-5-sonnet-latest"),
                 max_tokens=300,
                 temperature=0.3,
@@ -500,23 +870,17 @@ def chat():
                 messages=[{"role": "user", "content": message}],
             )
             text = resp.content[0].text if resp.content else ""
-            return jsonify({"reply": text or "Sorry, I couldn't generate a response."})
+            return ojson({"reply": text or "Sorry, I couldn't generate a response."})
         except Exception:
             # Fall back silently
             pass
 
     # Fallback
     lower = message.lower()
-    if "price" in lower or "rates" in lower:
-        reply = "Aap product cards par price dekh sakte hain. Jo pasand aaye us par 'Buy on WhatsApp' dabayein."
-    elif "delivery" in lower or "ship" in lower:
-        reply = "Delivery details seller WhatsApp par confirm karega. Buy button se contact karein."
-    elif "refund" in lower or "return" in lower:
-        reply = "Return/Refund policy seller se WhatsApp par confirm hoti hai. Product details share kar dein."
-    else:
-        reply = "Ji bilkul—main help kar deta hoon. Aap apna sawal detail me batayein ya product select karke Buy on WhatsApp use karein."
-
-    return jsonify({"reply": reply})
+    for keywords, body in _CHAT_RULES:
+        if any(k in lower for k in keywords):
+            return Response(body, mimetype="application/json")
+    return Response(_CHAT_DEFAULT_REPLY, mimetype="application/json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+# Hypercorn settings: `hypercorn --config file:hypercorn_conf.py app:app`.
+# Set MEMCACHED_SERVERS so all workers share sessions (see app.py).
+#
+# Hypercorn copies every public name in this module into its config and
+# pickles it for the workers, so keep helpers out of module scope.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app as _app  # noqa: E402
+
+bind = [os.getenv("BIND", "127.0.0.1:5000")]
+workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+worker_class = "uvloop"
+
+# Run migrations once here, before the workers are spawned.
+_app.init_db()